@@ -1,20 +1,35 @@
 import os
-import re
+import asyncio
+import base64
+import hashlib
+import hmac
 import time
 import logging
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import io
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from cachetools import TTLCache
 import firebase_admin
 from google import genai
 from google.genai import types
 from google.genai.types import GenerateContentConfig
 from PIL import Image
+from pythonjsonlogger import jsonlogger
+try:
+    import pyvips  # optional — libvips เร็วกว่า Pillow มากตอนย่อ JPEG (ถ้าไม่มีใช้ Pillow)
+except (ImportError, OSError):  # OSError = มี wheel แต่ไม่มี libvips shared library
+    pyvips = None
 from firebase_admin import credentials, db
 from flask import abort
 
 from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
     Configuration, ApiClient, MessagingApi, ReplyMessageRequest,
     TextMessage, MessagingApiBlob
@@ -33,102 +48,246 @@ SLIPOK_API_KEY            = os.environ.get('SLIPOK_API_KEY', '')
 FIREBASE_DB_URL           = os.environ.get('FIREBASE_DB_URL', '')
 GENAI_API_KEY             = os.environ.get('GENAI_API_KEY', '')
 
+# Cloud Tasks (ถ้าตั้งค่า) — ส่ง event ไปประมวลผลที่ line_task_handler แทน thread ในเครื่อง
+# CLOUD_TASKS_QUEUE = projects/<project>/locations/<region>/queues/<queue>
+CLOUD_TASKS_QUEUE         = os.environ.get('CLOUD_TASKS_QUEUE', '')
+CLOUD_TASKS_URL           = os.environ.get('CLOUD_TASKS_URL', '')
+CLOUD_TASKS_SA_EMAIL      = os.environ.get('CLOUD_TASKS_SA_EMAIL', '')
+
+# GET /warmup ต้องส่ง header X-Warmup-Token ตรงค่านี้ (ไม่ตั้ง = ปิด endpoint)
+WARMUP_TOKEN              = os.environ.get('WARMUP_TOKEN', '')
+
 # ==========================================
 # 2. INITIALIZE SERVICES
 # ==========================================
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Production (Cloud Run / Functions): log เป็น JSON ต่อบรรทัด ให้ Cloud Logging แยก severity ได้
+if os.environ.get('K_SERVICE'):
+    for log_handler in logging.getLogger().handlers:
+        log_handler.setFormatter(jsonlogger.JsonFormatter(
+            "%(levelname)s %(name)s %(message)s",
+            rename_fields={"levelname": "severity"},
+        ))
+
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+logging.getLogger("requests").setLevel(logging.WARNING)
+
 # Gemini Client — timeout=30 กัน LINE Webhook retry เมื่อ Gemini ช้า
 gemini_client = genai.Client(
     api_key=GENAI_API_KEY,
 ) if GENAI_API_KEY else None
 
 GEMINI_MODEL  = "gemini-2.5-flash-lite"
+GEMINI_SLIP_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "amount":    {"type": "number"},
+        "trans_ref": {"type": "string"},
+    },
+    "required": ["amount", "trans_ref"],
+}
 GEMINI_CONFIG = GenerateContentConfig(
     temperature=0.0,
     response_mime_type="application/json",
+    response_schema=GEMINI_SLIP_SCHEMA,
+    max_output_tokens=64,  # JSON 2 field — กันโมเดล generate ยาวเกิน
 )
 
-logger.info(f"Gemini client: {'✅ ready' if gemini_client else '⚠️ NOT initialized (GENAI_API_KEY not set)'}")
+logger.info("Gemini client: %s", '✅ ready' if gemini_client else '⚠️ NOT initialized (GENAI_API_KEY not set)')
 
 # Firebase
 if not firebase_admin._apps:
     cred = credentials.ApplicationDefault()
     firebase_admin.initialize_app(cred, {'databaseURL': FIREBASE_DB_URL})
 
+ROOT_REF = db.reference('/')
+
 configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
 handler       = WebhookHandler(LINE_CHANNEL_SECRET)
 
+# LINE client ตัวเดียวทั้ง process — reuse connection pool ไม่ต้องเปิด/ปิดทุก event
+api_client    = ApiClient(configuration)
+line_bot_api  = MessagingApi(api_client)
+line_bot_blob = MessagingApiBlob(api_client)
+
+# SlipOK Session — reuse connection (keep-alive) ไม่ต้อง TLS handshake ใหม่ทุกสลิป
+slipok_session = requests.Session()
+slipok_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    # retry POST เฉพาะตอน SlipOK ตอบ 502/503 — ไม่ retry read timeout กันสลิปถูกนับซ้ำ
+    max_retries=Retry(
+        total=2,
+        read=False,  # False = ส่ง ReadTimeout เดิมออกมา (0 จะกลายเป็น ConnectionError)
+        backoff_factor=0.2,
+        status_forcelist=[502, 503],
+        allowed_methods=["POST"],
+        raise_on_status=False,
+    ),
+))
+slipok_session.headers["x-authorization"] = SLIPOK_API_KEY
+
+# Cloud Tasks — งานเบื้องหลังรอดแม้ instance ถูกปิดหลังตอบ LINE (thread ในเครื่องไม่รอด)
+# import เฉพาะเมื่อตั้งค่า queue — ไม่ต้องโหลด grpc ทุก cold start
+if CLOUD_TASKS_QUEUE and CLOUD_TASKS_URL:
+    from google.api_core import exceptions as gcp_exceptions
+    from google.cloud import tasks_v2
+    tasks_client = tasks_v2.CloudTasksClient()
+else:
+    tasks_client = None
+
+# Worker pool — ตอบ LINE ทันที แล้วค่อยประมวลผล event เบื้องหลัง (LINE ต้องการ response ภายใน ~2s)
+executor = ThreadPoolExecutor(max_workers=8)
+
+# Event loop ของ Gemini (async client) รันใน thread เดียว — หลาย request รอ LLM พร้อมกันได้โดยไม่กิน worker เพิ่ม
+gemini_loop = asyncio.new_event_loop()
+threading.Thread(target=gemini_loop.run_forever, name="gemini-loop", daemon=True).start()
+
+# Pool แยกสำหรับงานย่อยภายใน handler (เช่นย่อรูป) — ห้ามใช้ pool เดียวกับ executor กัน deadlock
+image_executor = ThreadPoolExecutor(max_workers=4)
+
 # ==========================================
 # 3. CONSTANTS
 # ==========================================
-MACHINE_MAPPING_SLIP = {
-    "20.0":  "20",
-    "20":    "20",
-    "30.0":  "30",
-    "30":    "30",
-    "30.01": "301",
-    "40.0":  "40",
-    "40":    "40",
-    "50.0":  "50",
-    "50":    "50",
-}
-
-MACHINE_PATH_MAP_COUPON = {
-    "1": "20/payment_commands",
-    "2": "302/payment_commands",
-    "3": "301/payment_commands",
-    "4": "30/payment_commands",
+MACHINE_MAPPING_SLIP = {  # key = ยอดเงินเป็นสตางค์ (round(amount * 100)) กันปัญหาเทียบ float
+    2000: "20/payment_commands",
+    3000: "30/payment_commands",
+    3001: "301/payment_commands",
+    4000: "40/payment_commands",
+    5000: "50/payment_commands",
 }
 
 DEFAULT_PATH        = "payment_commands"
-SLIPOK_BYPASS_CODES = {"1009", "1010"}  # ธนาคารล่ม/ช้า
+
+MACHINE_PATH_MAP_COUPON = (  # index = เลขเครื่อง (1-4), index 0 ไม่ใช้
+    DEFAULT_PATH,
+    "20/payment_commands",
+    "302/payment_commands",
+    "301/payment_commands",
+    "30/payment_commands",
+)
+
+SLIPOK_BYPASS_CODES      = {"1009", "1010"}  # ธนาคารล่ม/ช้า
+SLIPOK_TIMEOUT           = (3.05, 7)         # (connect, read) วินาที
+SLIP_PRESHRINK_BYTES     = 2_000_000         # รูปใหญ่กว่านี้ย่อก่อนส่ง SlipOK
+GEMINI_TIMEOUT           = 20                # วินาที รอผล Gemini หลัง SlipOK ตอบ bypass
+GEMINI_IMAGE_MAX_SIZE    = 1024              # px ด้านยาวสุดของรูปที่ส่ง Gemini
+GEMINI_IMAGE_QUALITY     = 75                # JPEG quality ของรูปที่ส่ง Gemini
+GEMINI_SKIP_ENCODE_BYTES = 300_000           # JPEG เล็กกว่านี้ (และ ≤ max size) ส่ง Gemini ได้เลย ไม่ encode ใหม่
+SEEN_IDS_MAX             = 4096              # จำนวน message.id ล่าสุดที่จำไว้กัน LINE retry
+WARMUP_GEMINI_TIMEOUT_MS = 5000              # ms timeout ของ Gemini ping ใน GET /warmup
+WARMUP_TIMEOUT           = 5                 # วินาที timeout ของ Gemini ตอน warmup (cold start)
+CLOUD_TASKS_TIMEOUT      = 0.8               # วินาที ต่อครั้งของ create_task (ลองได้ 2 ครั้ง ให้ทัน 2s ของ LINE)
+
+_seen_ids      = OrderedDict()
+_seen_ids_lock = threading.Lock()
+
+# คูปองที่ไม่มี/ใช้ไปแล้ว — พิมพ์ซ้ำไม่ต้องอ่าน Firebase (ไม่ cache คูปองที่ยังใช้ได้ กันใช้ซ้ำข้าม instance)
+_missing_coupons      = TTLCache(maxsize=1024, ttl=30)
+_missing_coupons_lock = threading.Lock()
+
+# transRef ที่สั่งเครื่องไปแล้ว (1 ชม.) — ส่งสลิปเดิมซ้ำไม่ต้องเขียน Firebase / ไม่สั่งเครื่องซ้ำ
+_seen_refs      = TTLCache(maxsize=4096, ttl=3600)
+_seen_refs_lock = threading.Lock()
+
+# Firebase push key (สร้างเองในเครื่อง เรียงตามเวลาเหมือน ref.push())
+PUSH_CHARS       = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+_push_lock       = threading.Lock()
+_last_push_time  = 0
+_last_rand_chars = [0] * 12
 
 # ==========================================
 # 4. HELPER FUNCTIONS
 # ==========================================
 
+def mark_seen(message_id):
+    """คืน False ถ้าเคยเห็น message.id นี้แล้ว (LINE ส่งซ้ำ) — เก็บแบบ LRU"""
+    with _seen_ids_lock:
+        if message_id in _seen_ids:
+            _seen_ids.move_to_end(message_id)
+            return False
+        _seen_ids[message_id] = True
+        while len(_seen_ids) > SEEN_IDS_MAX:
+            _seen_ids.popitem(last=False)
+        return True
+
+
+def parse_coupon_command(text):
+    """แยก "รหัส 5 หลัก + เลขเครื่อง" (12345-1 / 12345 1 / 123451 / 1234501) ด้วย slicing แทน regex"""
+    code, rest = text[:5], text[5:]
+    if len(code) != 5 or not code.isdecimal():
+        return None
+
+    if rest[:1] in ("-", " "):
+        rest = rest[1:]
+    if len(rest) == 2 and rest[0] == "0":
+        rest = rest[1:]
+    if len(rest) == 1 and rest in "123456789":
+        return code, rest
+    return None
+
+
+def claim_trans_ref(trans_ref, record):
+    """จอง transRef ก่อน push — คืน False ถ้าสลิปนี้ถูกใช้ไปแล้ว (check + set ใน lock เดียว)"""
+    with _seen_refs_lock:
+        if trans_ref in _seen_refs:
+            return False
+        _seen_refs[trans_ref] = record
+        return True
+
+
+def release_trans_ref(trans_ref):
+    with _seen_refs_lock:
+        _seen_refs.pop(trans_ref, None)
+
+
 def get_target_path_from_amount(amount):
     """เลือก Firebase path จากยอดเงิน"""
     if amount is None:
         return None
 
     try:
-        amt_str = str(amount)
-        if amt_str in MACHINE_MAPPING_SLIP:
-            return f"{MACHINE_MAPPING_SLIP[amt_str]}/payment_commands"
-
-        amt_float = float(amount)
-        if amt_float.is_integer():
-            amt_int_str = str(int(amt_float))
-            if amt_int_str in MACHINE_MAPPING_SLIP:
-                return f"{MACHINE_MAPPING_SLIP[amt_int_str]}/payment_commands"
+        return MACHINE_MAPPING_SLIP.get(round(float(amount) * 100))
+    except (TypeError, ValueError, OverflowError) as e:
+        logger.error("Error parsing amount: %s", e)
+        return None
 
-    except Exception as e:
-        logger.error(f"Error parsing amount: {e}")
 
-    return None
+@lru_cache(maxsize=64)
+def get_ref(path):
+    """cache reference ต่อ path (สร้างจาก ROOT_REF) — path เครื่องมีจำนวนจำกัด"""
+    return ROOT_REF.child(path)
 
 
 def push_command_to_firebase(data, path=None):
     target_path = path if path else DEFAULT_PATH
     try:
-        ref = db.reference(target_path)
+        ref = get_ref(target_path)
         ref.push(data)
-        logger.info(f"Pushed to [{target_path}]: {data}")
+        logger.info("Pushed to [%s]: %s", target_path, data)
         return True
     except Exception as e:
-        logger.error(f"Firebase push error [{target_path}]: {e}")
+        logger.error("Firebase push error [%s]: %s", target_path, e)
         return False
 
 
+def mark_coupon_missing(code):
+    with _missing_coupons_lock:
+        _missing_coupons[code] = True
+
+
 def check_and_redeem_coupon(code):
+    with _missing_coupons_lock:
+        if code in _missing_coupons:
+            return False, 0
+
     try:
-        ref      = db.reference(f'coupons/{code}')
+        ref      = get_ref('coupons').child(code)
         snapshot = ref.get()
     except Exception as e:
-        logger.error(f"Coupon read error: {e}")
+        logger.error("Coupon read error: %s", e)
         return False, 0
 
     if snapshot:
@@ -141,96 +300,157 @@ def check_and_redeem_coupon(code):
             except Exception:
                 pass
         return True, coupon_value
+
+    mark_coupon_missing(code)
     return False, 0
 
 
-def delete_coupon(code):
+def generate_push_key():
+    """สร้าง key แบบเดียวกับ Firebase push() โดยไม่ต้องยิง request — เรียงตามเวลา ไม่ซ้ำกัน"""
+    global _last_push_time
+
+    with _push_lock:
+        now = time.time_ns() // 1_000_000
+        if now == _last_push_time:
+            # ms เดียวกัน: บวก 1 ให้ส่วน random เพื่อให้ key ยังเรียงลำดับถูก
+            i = 11
+            while i >= 0 and _last_rand_chars[i] == 63:
+                _last_rand_chars[i] = 0
+                i -= 1
+            _last_rand_chars[i] += 1
+        else:
+            _last_push_time = now
+            for i in range(12):
+                _last_rand_chars[i] = random.randrange(64)
+
+        time_chars = []
+        for _ in range(8):
+            time_chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+
+        return "".join(reversed(time_chars)) + "".join(PUSH_CHARS[c] for c in _last_rand_chars)
+
+
+def push_command_and_delete_coupon(data, path, code):
+    """push คำสั่ง + ลบคูปองใน multi-path update ครั้งเดียว (1 round trip แทน 2)"""
+    target_path = path if path else DEFAULT_PATH
     try:
-        db.reference(f'coupons/{code}').delete()
+        ROOT_REF.update({
+            f"{target_path}/{generate_push_key()}": data,
+            f"coupons/{code}":                      None,
+        })
+        mark_coupon_missing(code)
+        logger.info("Pushed to [%s] and deleted coupon %s: %s", target_path, code, data)
+        return True
     except Exception as e:
-        logger.error(f"Coupon delete error: {e}")
+        logger.error("Firebase coupon update error [%s]: %s", target_path, e)
+        return False
 
 
 def check_slip_with_slipok(image_binary):
     """ตรวจสอบสลิปกับ SlipOK"""
-    url     = f"https://api.slipok.com/api/line/apikey/{SLIPOK_BRANCH_ID}"
-    headers = {"x-authorization": SLIPOK_API_KEY}
-    files   = {"files": ("slip.jpg", image_binary, "image/jpeg")}
-    data    = {"log": "true"}
+    url   = f"https://api.slipok.com/api/line/apikey/{SLIPOK_BRANCH_ID}"
+    files = {"files": ("slip.jpg", image_binary, "image/jpeg")}
+    data  = {"log": "true"}  # ต้องส่ง — SlipOK ใช้ log ในการเช็คสลิปซ้ำ
 
     try:
-        response = requests.post(url, headers=headers, files=files, data=data, timeout=10)
-        res_json = response.json()
+        response = slipok_session.post(url, files=files, data=data, timeout=SLIPOK_TIMEOUT)
+
+        # SlipOK ล่ม (5xx หลัง retry แล้ว) — ไม่ต้อง parse body ส่งให้ AI อ่านเลย
+        if response.status_code >= 500:
+            logger.warning("SlipOK HTTP %s - Switching to AI", response.status_code)
+            return True, None
+
+        res_json = orjson.loads(response.content)
 
         if response.status_code == 200 and res_json.get('success'):
             return True, res_json.get('data')
 
         error_code = res_json.get('code')
         if str(error_code) in SLIPOK_BYPASS_CODES:
-            logger.warning(f"SlipOK Delayed: {error_code} - Switching to AI")
+            logger.warning("SlipOK Delayed: %s - Switching to AI", error_code)
             return True, None
 
         return False, None
 
+    except requests.exceptions.ReadTimeout:
+        logger.warning("SlipOK read timeout - Switching to AI")
+        return True, None
+
     except Exception as e:
-        logger.error(f"SlipOK error: {e}")
+        logger.error("SlipOK error: %s", e)
         return False, None
 
 
+def is_small_jpeg(image_binary):
+    """JPEG ไฟล์เล็กและขนาดไม่เกินที่ส่ง Gemini อยู่แล้ว — อ่านแค่ header ไม่ decode ทั้งรูป"""
+    if len(image_binary) >= GEMINI_SKIP_ENCODE_BYTES:
+        return False
+
+    try:
+        image = Image.open(io.BytesIO(image_binary))
+        return (image.format == 'JPEG' and image.mode == 'RGB'
+                and max(image.size) <= GEMINI_IMAGE_MAX_SIZE)
+    except Exception:
+        return False
+
+
+def optimize_image_with_vips(image_binary):
+    """ย่อรูปด้วย libvips — thumbnail_buffer ย่อตั้งแต่ตอน decode (shrink-on-load)"""
+    image = pyvips.Image.thumbnail_buffer(image_binary, GEMINI_IMAGE_MAX_SIZE, size="down")
+    image = image.colourspace("srgb")
+    return image.jpegsave_buffer(Q=GEMINI_IMAGE_QUALITY, strip=True, optimize_coding=True)
+
+
 def optimize_image_for_gemini(image_binary):
     """ย่อรูปและลดคุณภาพ แล้วคืน bytes โดยตรง (ลด memory footprint)"""
+    if is_small_jpeg(image_binary):
+        return image_binary
+
+    if pyvips:
+        try:
+            return optimize_image_with_vips(image_binary)
+        except Exception as e:
+            logger.warning("libvips optimization failed, falling back to Pillow: %s", e)
+
     try:
         image    = Image.open(io.BytesIO(image_binary))
-        max_size = 1024
+        max_size = GEMINI_IMAGE_MAX_SIZE
+
+        # JPEG: ให้ libjpeg decode ที่ขนาดย่อ (1/2, 1/4, 1/8) เลย ไม่ต้อง decode ความละเอียดเต็ม
+        image.draft('RGB', (max_size, max_size))
 
+        # BILINEAR พอสำหรับให้ AI อ่านตัวอักษร — เร็วกว่า LANCZOS หลายเท่า
         if max(image.size) > max_size:
-            ratio    = max_size / max(image.size)
-            new_size = (int(image.width * ratio), int(image.height * ratio))
-            image    = image.resize(new_size, Image.Resampling.LANCZOS)
+            image.thumbnail((max_size, max_size), Image.Resampling.BILINEAR)
 
         if image.mode != 'RGB':
             image = image.convert('RGB')
 
         img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='JPEG', quality=85)
+        image.save(img_byte_arr, format='JPEG', quality=GEMINI_IMAGE_QUALITY)
         return img_byte_arr.getvalue()
 
     except Exception as e:
-        logger.error(f"Image Optimization Error: {e}")
+        logger.error("Image Optimization Error: %s", e)
         return image_binary
 
 
-def clean_json_text(text):
-    """ล้าง Markdown backticks ออกจาก JSON string กัน json.loads แตก"""
-    text = text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
-    return text.strip()
-
-
-def check_slip_with_gemini(image_binary):
-    """ใช้ Gemini 2.5 Flash Lite อ่านสลิปเมื่อธนาคารล่ม (AI fallback)"""
+async def check_slip_with_gemini(optimized_bytes):
+    """ใช้ Gemini 2.5 Flash Lite อ่านสลิปเมื่อธนาคารล่ม (AI fallback) — รับรูปที่ย่อแล้ว"""
     if not gemini_client:
         logger.error("Gemini client not initialized")
         return None, None
 
     try:
-        optimized_bytes = optimize_image_for_gemini(image_binary)
-
         prompt = """
         You are a system to extract data from Thai bank slips.
         Analyze this image.
         1. "amount": The transfer amount (number only, float). Ignore balance available.
         2. "trans_ref": The transaction reference number.
-
-        Return strictly JSON: {"amount": float, "trans_ref": string}
         """
 
-        response = gemini_client.models.generate_content(
+        response = await gemini_client.aio.models.generate_content(
             model=GEMINI_MODEL,
             contents=[
                 prompt,
@@ -239,19 +459,77 @@ def check_slip_with_gemini(image_binary):
             config=GEMINI_CONFIG,
         )
 
-        try:
-            result = json.loads(clean_json_text(response.text))
-            logger.info(f"Gemini Analysis: {result}")
-            return result.get("amount"), result.get("trans_ref")
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON Decode Error. Raw AI Response: {response.text}")
-            return None, None
+        # มี response_schema แล้ว SDK decode JSON ให้ใน response.parsed (ไม่มี ``` ครอบ)
+        result = response.parsed
+        if result is None:
+            try:
+                result = orjson.loads(response.text)
+            except (orjson.JSONDecodeError, TypeError):
+                logger.error("JSON Decode Error. Raw AI Response: %s", response.text)
+                return None, None
+
+        logger.info("Gemini Analysis: %s", result)
+        return result.get("amount"), result.get("trans_ref")
 
     except Exception as e:
-        logger.error(f"Gemini AI Error: {e}")
+        logger.error("Gemini AI Error: %s", e)
         return None, None
 
 
+async def check_slip_with_gemini_after(optimize_future):
+    """รอรูปที่ย่อจาก image_executor แล้วส่งต่อให้ Gemini — ใช้ยิง Gemini คู่ขนานกับ SlipOK"""
+    optimized_bytes = await asyncio.wrap_future(optimize_future)
+    return await check_slip_with_gemini(optimized_bytes)
+
+
+async def list_gemini_models():
+    """ดึงรายชื่อโมเดล 1 หน้า (ไม่คิดเงิน) — เปิด connection ของ async client ที่ใช้อ่านสลิป"""
+    await gemini_client.aio.models.list(config=types.ListModelsConfig(
+        page_size=1,
+        http_options=types.HttpOptions(timeout=WARMUP_TIMEOUT * 1000),
+    ))
+
+
+def warmup():
+    """โหลด Pillow / Firebase / Gemini ล่วงหน้าตอน cold start ให้ request แรกไม่ต้องรอ (ไม่คิดเงิน)"""
+    Image.new('RGB', (1, 1))
+    get_ref(DEFAULT_PATH)
+
+    try:
+        ROOT_REF.child('healthcheck').get()
+    except Exception as e:
+        logger.warning("Firebase warmup failed: %s", e)
+
+    if gemini_client:
+        try:
+            asyncio.run_coroutine_threadsafe(list_gemini_models(), gemini_loop).result(timeout=WARMUP_TIMEOUT)
+        except Exception as e:
+            logger.warning("Gemini warmup failed: %s", e)
+
+
+async def ping_gemini():
+    """generate_content 1 token ผ่าน async client ตัวเดียวกับที่อ่านสลิป"""
+    await gemini_client.aio.models.generate_content(
+        model=GEMINI_MODEL,
+        contents="ping",
+        config=GenerateContentConfig(
+            max_output_tokens=1,
+            http_options=types.HttpOptions(timeout=WARMUP_GEMINI_TIMEOUT_MS),
+        ),
+    )
+
+
+def warmup_remote():
+    """ยิง Gemini generate_content จริง (คิดเงิน) — เรียกจาก GET /warmup เท่านั้น"""
+    if gemini_client:
+        try:
+            asyncio.run_coroutine_threadsafe(ping_gemini(), gemini_loop).result(
+                timeout=WARMUP_GEMINI_TIMEOUT_MS / 1000
+            )
+        except Exception as e:
+            logger.warning("Gemini warmup failed: %s", e)
+
+
 def safe_reply(line_bot_api, reply_token, text):
     try:
         line_bot_api.reply_message(
@@ -261,7 +539,12 @@ def safe_reply(line_bot_api, reply_token, text):
             )
         )
     except Exception as e:
-        logger.error(f"Reply failed: {e}")
+        logger.error("Reply failed: %s", e)
+
+
+# Cloud Functions / Cloud Run เท่านั้น (มี K_SERVICE) — รันใน daemon thread ไม่ให้ startup ต้องรอ network
+if os.environ.get('K_SERVICE'):
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
 
 
 # ==========================================
@@ -270,118 +553,244 @@ def safe_reply(line_bot_api, reply_token, text):
 
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_message(event):
+    if not mark_seen(event.message.id):
+        logger.info("Duplicate message skipped: %s", event.message.id)
+        return
+
     text = event.message.text.strip()
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
 
-        if text.upper() == "KEY":
-            safe_reply(line_bot_api, event.reply_token,
-                       "🔑 พิมพ์รหัสตามด้วยหมายเลขเครื่อง\nเช่น 12345-1 (นับจากซ้ายไปขวา)")
-            return
+    if text.upper() == "KEY":
+        safe_reply(line_bot_api, event.reply_token,
+                   "🔑 พิมพ์รหัสตามด้วยหมายเลขเครื่อง\nเช่น 12345-1 (นับจากซ้ายไปขวา)")
+        return
+
+    match_machine = parse_coupon_command(text)
 
-        match_machine = re.match(r'^(\d{5})[- ]?0?([1-9])$', text)
-
-        if match_machine:
-            code, machine_num = match_machine.groups()
-            exists, _         = check_and_redeem_coupon(code)
-
-            if exists:
-                timestamp    = int(time.time() * 1000)
-                target_path  = MACHINE_PATH_MAP_COUPON.get(machine_num, DEFAULT_PATH)
-                command_data = {
-                    "status":           "work",
-                    "method":           "coupon",
-                    "code":             code,
-                    "selected_machine": machine_num,
-                    "transRef":         f"coupon-{code}-{timestamp}",
-                    "timestamp":        timestamp,
-                }
-                if push_command_to_firebase(command_data, target_path):
-                    delete_coupon(code)
-                    safe_reply(line_bot_api, event.reply_token,
-                               f"✅ รหัสถูกต้อง!\nสั่งงานเครื่องที่ {machine_num} เรียบร้อย")
-                else:
-                    safe_reply(line_bot_api, event.reply_token, "❌ ระบบขัดข้อง กรุณาลองใหม่")
+    if match_machine:
+        code, machine_num = match_machine
+        exists, _         = check_and_redeem_coupon(code)
+
+        if exists:
+            timestamp    = time.time_ns() // 1_000_000
+            machine_idx  = int(machine_num)
+            target_path  = (MACHINE_PATH_MAP_COUPON[machine_idx]
+                            if machine_idx < len(MACHINE_PATH_MAP_COUPON) else DEFAULT_PATH)
+            command_data = {
+                "status":           "work",
+                "method":           "coupon",
+                "code":             code,
+                "selected_machine": machine_num,
+                "transRef":         f"coupon-{code}-{timestamp}",
+                "timestamp":        timestamp,
+            }
+            if push_command_and_delete_coupon(command_data, target_path, code):
+                safe_reply(line_bot_api, event.reply_token,
+                           f"✅ รหัสถูกต้อง!\nสั่งงานเครื่องที่ {machine_num} เรียบร้อย")
             else:
-                safe_reply(line_bot_api, event.reply_token, "❌ รหัสไม่ถูกต้อง")
+                safe_reply(line_bot_api, event.reply_token, "❌ ระบบขัดข้อง กรุณาลองใหม่")
+        else:
+            safe_reply(line_bot_api, event.reply_token, "❌ รหัสไม่ถูกต้อง")
 
 
 @handler.add(MessageEvent, message=ImageMessageContent)
 def handle_image_message(event):
     message_id = event.message.id
+    if not mark_seen(message_id):
+        logger.info("Duplicate message skipped: %s", message_id)
+        return
+
+    # 1. ดึงรูปภาพ — ใช้ค่าจาก SDK ตรงๆ ไม่แปลงเพิ่ม
+    message_content = line_bot_blob.get_message_content(message_id)
+
+    # 2. เช็ค SlipOK (ด่านแรก) — ย่อรูป + ให้ Gemini อ่านสลิปไปพร้อมกัน (เผื่อธนาคารดีเลย์)
+    optimize_future = image_executor.submit(optimize_image_for_gemini, message_content)
+    gemini_future   = asyncio.run_coroutine_threadsafe(
+        check_slip_with_gemini_after(optimize_future), gemini_loop
+    )
+    if len(message_content) > SLIP_PRESHRINK_BYTES:
+        # รูปใหญ่: รอย่อก่อน แล้วส่งไฟล์เล็กให้ทั้ง SlipOK และ Gemini
+        message_content = optimize_future.result()
+
+    is_valid, slip_data = check_slip_with_slipok(message_content)
+
+    # ไม่ใช้รูปต้นฉบับแล้ว — ปล่อย memory ก่อนรอ Gemini/Firebase (ช่วงที่ใช้เวลานาน)
+    del message_content
+
+    if not is_valid or slip_data:
+        optimize_future.cancel()
+        gemini_future.cancel()
+
+    if not is_valid:
+        safe_reply(line_bot_api, event.reply_token, "❌ สลิปไม่ถูกต้อง/ซ้ำ/ยอดเงินไม่ตรง")
+        return
+
+    amount    = None
+    trans_ref = None
+    method    = "slip"
+    timestamp = time.time_ns() // 1_000_000
+
+    # 3. แยกเคส: ปกติ vs ธนาคารดีเลย์
+    if slip_data:
+        # เคสปกติ: ได้ข้อมูลครบจาก SlipOK
+        amount    = slip_data.get('amount')
+        trans_ref = slip_data.get('transRef')
+    else:
+        # เคสดีเลย์ (1009/1010): ให้ AI ช่วยอ่าน
+        try:
+            ai_amount, ai_ref = gemini_future.result(timeout=GEMINI_TIMEOUT)
+        except FutureTimeoutError:
+            logger.error("Gemini AI timeout")
+            gemini_future.cancel()
+            ai_amount, ai_ref = None, None
+
+        if ai_amount:
+            amount    = ai_amount
+            trans_ref = ai_ref or f"ai-{timestamp}"
+            method    = "ai_fallback"
+            logger.info("AI Found amount: %s", amount)
+        else:
+            safe_reply(line_bot_api, event.reply_token,
+                       "⚠️ ธนาคารขัดข้องและระบบอ่านยอดเงินไม่ได้\nกรุณาติดต่อแอดมิน")
+            return
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api  = MessagingApi(api_client)
-        line_bot_blob = MessagingApiBlob(api_client)
+    # 4. หา Path และส่งคำสั่ง
+    target_path = get_target_path_from_amount(amount)
+
+    if target_path:
+        command_data = {
+            "status":    "work",
+            "method":    method,
+            "amount":    amount,
+            "transRef":  trans_ref,
+            "timestamp": timestamp,
+        }
+        if trans_ref and not claim_trans_ref(trans_ref, (amount, method, target_path)):
+            logger.info("Duplicate transRef skipped: %s", trans_ref)
+            safe_reply(line_bot_api, event.reply_token, "⚠️ สลิปนี้ถูกใช้งานไปแล้ว")
+            return
 
-        # 1. ดึงรูปภาพ — ใช้ค่าจาก SDK ตรงๆ ไม่แปลงเพิ่ม
-        message_content = line_bot_blob.get_message_content(message_id)
+        if push_command_to_firebase(command_data, target_path):
+            msg_prefix = "✅" if method == "slip" else "🤖(AI)"
+            safe_reply(line_bot_api, event.reply_token,
+                       f"{msg_prefix} ได้รับยอด {amount} บาท\n*******เริ่มทำงาน*******")
+        else:
+            if trans_ref:
+                release_trans_ref(trans_ref)
+            safe_reply(line_bot_api, event.reply_token, "❌ ระบบขัดข้อง กรุณาติดต่อแอดมิน")
+    else:
+        safe_reply(line_bot_api, event.reply_token,
+                   f"⚠️ ยอดเงิน {amount} บาท ไม่ตรงกับราคาเครื่อง\nกรุณาติดต่อแอดมิน")
 
-        # 2. เช็ค SlipOK (ด่านแรก)
-        is_valid, slip_data = check_slip_with_slipok(message_content)
 
-        if not is_valid:
-            safe_reply(line_bot_api, event.reply_token, "❌ สลิปไม่ถูกต้อง/ซ้ำ/ยอดเงินไม่ตรง")
-            return
+# ==========================================
+# 6. MAIN ENTRY POINT
+# ==========================================
+def is_valid_signature(body, signature):
+    """ตรวจ X-Line-Signature (HMAC-SHA256 ของ body) เอง — request ปลอมไม่ต้องไป parse JSON/dispatch"""
+    if not signature:
+        return False
 
-        amount    = None
-        trans_ref = None
-        method    = "slip"
-        timestamp = int(time.time() * 1000)
+    expected = base64.b64encode(
+        hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    )
+    return hmac.compare_digest(expected, signature.encode('utf-8'))
 
-        # 3. แยกเคส: ปกติ vs ธนาคารดีเลย์
-        if slip_data:
-            # เคสปกติ: ได้ข้อมูลครบจาก SlipOK
-            amount    = slip_data.get('amount')
-            trans_ref = slip_data.get('transRef')
-        else:
-            # เคสดีเลย์ (1009/1010): ให้ AI ช่วยอ่าน
-            ai_amount, ai_ref = check_slip_with_gemini(message_content)
-
-            if ai_amount:
-                amount    = ai_amount
-                trans_ref = ai_ref or f"ai-{timestamp}"
-                method    = "ai_fallback"
-                logger.info(f"AI Found amount: {amount}")
-            else:
-                safe_reply(line_bot_api, event.reply_token,
-                           "⚠️ ธนาคารขัดข้องและระบบอ่านยอดเงินไม่ได้\nกรุณาติดต่อแอดมิน")
-                return
 
-        # 4. หา Path และส่งคำสั่ง
-        target_path = get_target_path_from_amount(amount)
+def process_webhook_body(body, signature):
+    """รัน handler ใน worker thread — error ต้อง log เอง เพราะไม่มีใครรอผลลัพธ์"""
+    try:
+        handler.handle(body, signature)
+    except Exception as e:
+        logger.error("Webhook error: %s", e)
+
 
-        if target_path:
-            command_data = {
-                "status":    "work",
-                "method":    method,
-                "amount":    amount,
-                "transRef":  trans_ref,
-                "timestamp": timestamp,
-            }
-            if push_command_to_firebase(command_data, target_path):
-                msg_prefix = "✅" if method == "slip" else "🤖(AI)"
-                safe_reply(line_bot_api, event.reply_token,
-                           f"{msg_prefix} ได้รับยอด {amount} บาท\n*******เริ่มทำงาน*******")
-            else:
-                safe_reply(line_bot_api, event.reply_token, "❌ ระบบขัดข้อง กรุณาติดต่อแอดมิน")
-        else:
-            safe_reply(line_bot_api, event.reply_token,
-                       f"⚠️ ยอดเงิน {amount} บาท ไม่ตรงกับราคาเครื่อง\nกรุณาติดต่อแอดมิน")
+def webhook_task_id(body):
+    """sha256 ของ webhookEventId ทุก event — body ตอน redelivery ต่างจากเดิม (isRedelivery) แต่ event id เดิม"""
+    try:
+        event_ids = [e["webhookEventId"] for e in orjson.loads(body)["events"]]
+        key       = ",".join(event_ids) if event_ids else body
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        key = body
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def enqueue_webhook_task(body, signature):
+    """ส่ง body + signature เดิมของ LINE เข้า Cloud Tasks — line_task_handler ตรวจ signature ซ้ำเอง"""
+    http_request = {
+        "http_method": tasks_v2.HttpMethod.POST,
+        "url":         CLOUD_TASKS_URL,
+        "headers":     {"Content-Type": "application/json", "X-Line-Signature": signature},
+        "body":        body.encode('utf-8'),
+    }
+    if CLOUD_TASKS_SA_EMAIL:
+        http_request["oidc_token"] = {"service_account_email": CLOUD_TASKS_SA_EMAIL}
+
+    # ชื่อ task คงที่ต่อ event — LINE ส่งซ้ำ/enqueue ซ้ำ Cloud Tasks ตอบ ALREADY_EXISTS แทนสร้างใหม่
+    task = {
+        "name":         f"{CLOUD_TASKS_QUEUE}/tasks/{webhook_task_id(body)}",
+        "http_request": http_request,
+    }
+
+    # timeout สั้นให้ทัน 2s ของ LINE — timeout แล้วลองซ้ำอีกครั้ง ถ้าครั้งแรกสร้างไปแล้วจะได้ ALREADY_EXISTS
+    for attempt in range(2):
+        try:
+            tasks_client.create_task(parent=CLOUD_TASKS_QUEUE, task=task, timeout=CLOUD_TASKS_TIMEOUT)
+            return
+        except gcp_exceptions.AlreadyExists:
+            logger.info("Cloud Task already exists: %s", task["name"])
+            return
+        except (gcp_exceptions.DeadlineExceeded, gcp_exceptions.ServiceUnavailable):
+            if attempt:
+                raise
+
+
+def handle_warmup(request):
+    """GET /warmup (startup probe / scheduler) — อุ่น instance ของ webhook นี้เอง ก่อนมี event จริง"""
+    # ยิง Gemini (คิดเงิน) — ต้องส่ง X-Warmup-Token ให้ตรง WARMUP_TOKEN (ไม่ตั้ง = ปิด)
+    token = request.headers.get('X-Warmup-Token', '')
+    if not WARMUP_TOKEN or not hmac.compare_digest(token.encode('utf-8'), WARMUP_TOKEN.encode('utf-8')):
+        abort(403)
+
+    warmup()
+    warmup_remote()
+    return 'OK'
 
 
-# ==========================================
-# 6. MAIN ENTRY POINT
-# ==========================================
 def line_webhook(request):
+    if request.method == 'GET' and request.path == '/warmup':
+        return handle_warmup(request)
+
     signature = request.headers.get('X-Line-Signature')
     body      = request.get_data(as_text=True)
 
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    # ตรวจ signature ก่อน แล้วตอบ OK ทันที — งานหนัก (SlipOK/Gemini/Firebase) ไปทำเบื้องหลัง
+    if not is_valid_signature(body, signature):
         abort(400)
+
+    if tasks_client:
+        try:
+            enqueue_webhook_task(body, signature)
+            return 'OK'
+        except Exception as e:
+            # LINE ไม่ส่งซ้ำเมื่อได้ 200 — ห้ามทิ้ง event ให้ประมวลผลในเครื่องแทน
+            logger.error("Cloud Tasks enqueue error, processing locally: %s", e)
+
+    try:
+        executor.submit(process_webhook_body, body, signature)
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
+        logger.error("Webhook enqueue error: %s", e)
         return 'Error', 200
     return 'OK'
+
+
+def line_task_handler(request):
+    """Entry point ที่ Cloud Tasks เรียก — ประมวลผล event จริง (ไม่มี LINE รอ 2s แล้ว)"""
+    signature = request.headers.get('X-Line-Signature')
+    body      = request.get_data(as_text=True)
+
+    if not is_valid_signature(body, signature):
+        abort(400)
+
+    # ตอบ 200 เสมอ — ไม่ให้ Cloud Tasks retry แล้วสั่งเครื่องซ้ำ
+    process_webhook_body(body, signature)
+    return 'OK'